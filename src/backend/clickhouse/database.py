@@ -1,10 +1,94 @@
 import contextlib
-from typing import List, Tuple, Union
+from collections import defaultdict
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Union
 
 import asynch
+from asynch.connection import Connection
 from asynch.cursors import DictCursor
 from asynch.pool import Pool
 
+_TABLE_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    "videos": ("id", "user_id", "created_at", "duration", "view_count"),
+    "clips": ("id", "video_id", "created_at", "duration", "view_count", "vod_offset"),
+    "messages": (
+        "id",
+        "video_id",
+        "created_at",
+        "commenter_name",
+        "content",
+        "text",
+        "emotes",
+    ),
+    "emotes": ("id", "broadcaster_id", "source", "name"),
+}
+
+_CREATE_SQL: Dict[str, str] = {
+    "videos": """
+        CREATE TABLE IF NOT EXISTS videos (
+            id UInt32,
+            user_id UInt32,
+            created_at DateTime,
+            duration String,
+            view_count UInt32
+        ) ENGINE = MergeTree
+        ORDER BY created_at
+    """,
+    "clips": """
+        CREATE TABLE IF NOT EXISTS clips (
+            id String,
+            video_id UInt32,
+            created_at DateTime,
+            duration UInt32,
+            view_count UInt32,
+            vod_offset UInt32
+        ) ENGINE = MergeTree
+        ORDER BY created_at
+    """,
+    "messages": """
+        CREATE TABLE IF NOT EXISTS messages (
+            id String,
+            video_id UInt32,
+            created_at DateTime,
+            commenter_name Nullable(String),
+            content Nullable(String),
+            text Nullable(String),
+            emotes Array(Nullable(String))
+        ) ENGINE = MergeTree
+        ORDER BY created_at
+    """,
+    "emotes": """
+        CREATE TABLE IF NOT EXISTS emotes (
+            id String,
+            broadcaster_id UInt32,
+            source String,
+            name String
+        ) ENGINE = MergeTree
+        ORDER BY broadcaster_id
+    """,
+    # flushes into messages once any max or all min thresholds are reached
+    "messages_buffer": """
+        CREATE TABLE IF NOT EXISTS messages_buffer AS messages
+        ENGINE = Buffer(
+            currentDatabase(), messages, 16, 10, 60, 10000, 100000, 1000000, 10000000
+        )
+    """,
+}
+
+# tables whose inserts go through another table, which merges the rows
+# of several inserts before writing them, so they are not sorted on insert
+_INSERT_TABLES: Dict[str, str] = {
+    "messages": "messages_buffer",
+}
+
+# extract the ORDER BY column of each table from a row, or from the columns
+_SORT_KEYS: Dict[str, Callable[[Tuple], Any]] = {
+    "videos": itemgetter(2),
+    "clips": itemgetter(2),
+    "messages": itemgetter(2),
+    "emotes": itemgetter(1),
+}
+
 
 class Database:
     def __init__(self):
@@ -13,6 +97,8 @@ class Database:
         """
         self.pool: Union[Pool, None] = None
         self.database: str = "default"
+        self._buffers: Dict[str, List[Tuple]] = defaultdict(list)
+        self._insert_queries: Dict[str, str] = {}
 
     @contextlib.asynccontextmanager
     async def create_pool(self, **kwargs):
@@ -24,9 +110,15 @@ class Database:
         """
         self.pool = await asynch.create_pool(**kwargs)
         self.database = kwargs["database"]
-        yield self.pool
-        self.pool.close()
-        await self.pool.wait_closed()
+        self._insert_queries = {
+            table_name: f"INSERT INTO {self.database}.{_INSERT_TABLES.get(table_name, table_name)} ({', '.join(columns)}) VALUES"
+            for table_name, columns in _TABLE_COLUMNS.items()
+        }
+        try:
+            yield self.pool
+        finally:
+            self.pool.close()
+            await self.pool.wait_closed()
 
     async def execute(self, query: str):
         """
@@ -37,10 +129,34 @@ class Database:
         """
         async with self.pool.acquire() as conn:
             async with conn.cursor(cursor=DictCursor) as cursor:
-                try:
-                    await cursor.execute(query)
-                except Exception as e:
-                    print(f"Error executing query: {e}")
+                await cursor.execute(query)
+
+    async def fetch_videos(
+        self, ids: List[int], cursor: DictCursor = None
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Fetch the metadata of several videos with a single query.
+
+        Args:
+            ids: The IDs of the videos to fetch.
+            cursor: An open DictCursor to run the query on (optional).
+
+        Returns:
+            A dictionary mapping video IDs to the video rows.
+        """
+        ids = tuple(int(video_id) for video_id in ids)
+        if not ids:
+            return {}
+        if cursor is None:
+            async with self.pool.acquire() as conn:
+                async with conn.cursor(cursor=DictCursor) as own_cursor:
+                    return await self.fetch_videos(ids, own_cursor)
+
+        await cursor.execute(
+            f"SELECT * FROM {self.database}.videos WHERE id IN %(ids)s",
+            {"ids": ids},
+        )
+        return {row["id"]: row for row in await cursor.fetchall()}
 
     async def create_table(self, table_name: str):
         """
@@ -70,53 +186,7 @@ class Database:
         Returns:
             The query to create the table.
         """
-        match table_name:
-            case "videos":
-                return """
-                            CREATE TABLE IF NOT EXISTS videos (
-                                id UInt32,
-                                user_id UInt32,
-                                created_at DateTime,
-                                duration String,
-                                view_count UInt32
-                            ) ENGINE = MergeTree
-                            ORDER BY created_at
-                        """
-            case "clips":
-                return """
-                            CREATE TABLE IF NOT EXISTS clips (
-                                id String,
-                                video_id UInt32,
-                                created_at DateTime,
-                                duration UInt32,
-                                view_count UInt32,
-                                vod_offset UInt32
-                            ) ENGINE = MergeTree
-                            ORDER BY created_at
-                        """
-            case "messages":
-                return """
-                            CREATE TABLE IF NOT EXISTS messages (
-                                id String,
-                                video_id UInt32,
-                                created_at DateTime,
-                                commenter_name Nullable(String),
-                                content Nullable(String),
-                                text Nullable(String),
-                                emotes Array(Nullable(String))
-                            ) ENGINE = MergeTree
-                            ORDER BY created_at
-                        """
-            case "emotes":
-                return """
-                            CREATE TABLE IF NOT EXISTS emotes (
-                                id String,
-                                broadcaster_id UInt32,
-                                source String,
-                                name String
-                            ) ENGINE = MergeTree
-                            ORDER BY broadcaster_id
-                        """
+        return _CREATE_SQL[table_name]
 
     async def insert_in_table(self, table_name: str, values: List[Tuple]):
         """
@@ -126,48 +196,81 @@ class Database:
             table_name: The name of the table to insert values into.
             values: The values to insert.
         """
-        columns = self._get_table_columns(table_name)
+        if table_name not in _INSERT_TABLES:
+            # MergeTree skips sorting blocks that already follow the ORDER BY key
+            values = sorted(values, key=_SORT_KEYS[table_name])
+        query = self._insert_queries[table_name]
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
-                await cursor.execute(
-                    f"""INSERT INTO {self.database}.{table_name} ({', '.join(columns)}) VALUES""",
-                    values,
-                )
+                await cursor.executemany(query, values)
 
-    def _get_table_columns(self, table_name: str):
+    async def insert_columns(self, table_name: str, columns: Sequence[List]):
         """
-        Get the columns of a table.
+        Insert values given column by column into a table.
 
         Args:
-            table_name: The name of the table to get the columns from.
+            table_name: The name of the table to insert values into.
+            columns: The columns of values, in the column order of the table.
+        """
+        sort_column = _SORT_KEYS[table_name](columns)
+        if table_name not in _INSERT_TABLES and len(sort_column) > 1:
+            # MergeTree skips sorting blocks that already follow the ORDER BY key
+            order = itemgetter(
+                *sorted(range(len(sort_column)), key=sort_column.__getitem__)
+            )
+            columns = [order(column) for column in columns]
+        query = self._insert_queries[table_name]
+        async with self.pool.acquire() as conn:
+            await self._execute_columnar(conn, query, columns)
 
-        Returns:
-            A list of the columns of the table.
-        """
-        match table_name:
-            case "videos":
-                return ["id", "user_id", "created_at", "duration", "view_count"]
-            case "clips":
-                return [
-                    "id",
-                    "video_id",
-                    "created_at",
-                    "duration",
-                    "view_count",
-                    "vod_offset",
-                ]
-            case "messages":
-                return [
-                    "id",
-                    "video_id",
-                    "created_at",
-                    "commenter_name",
-                    "content",
-                    "text",
-                    "emotes",
-                ]
-            case "emotes":
-                return ["id", "broadcaster_id", "source", "name"]
+    @staticmethod
+    async def _execute_columnar(conn: Connection, query: str, columns: Sequence[List]):
+        """
+        Execute an INSERT query with values given column by column.
+
+        asynch cursors only take rows and expose no columnar flag, so this
+        goes through the protocol connection the cursors execute queries on.
+
+        Args:
+            conn: A connection acquired from the pool.
+            query: The INSERT query to execute.
+            columns: The columns of values, in the column order of the query.
+        """
+        await conn._connection.execute(query, columns, columnar=True)
+
+    async def buffered_insert(
+        self, table_name: str, values: List[Tuple], flush_at: int = 65536
+    ):
+        """
+        Buffer values for a table and insert them once enough rows are collected.
+
+        Args:
+            table_name: The name of the table to insert values into.
+            values: The values to insert.
+            flush_at: The number of buffered rows that triggers an insert.
+        """
+        buffer = self._buffers[table_name]
+        buffer.extend(values)
+        if len(buffer) >= flush_at:
+            await self.flush(table_name)
+
+    async def flush(self, table_name: str):
+        """
+        Insert all buffered values of a table.
+
+        Args:
+            table_name: The name of the table to flush.
+        """
+        values = self._buffers.pop(table_name, None)
+        if values:
+            await self.insert_in_table(table_name, values)
+
+    async def flush_all(self):
+        """
+        Insert all buffered values of every table.
+        """
+        for table_name in list(self._buffers):
+            await self.flush(table_name)
 
 
 db = Database()
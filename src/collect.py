@@ -8,6 +8,7 @@ from hydra import compose, initialize
 from src.backend.clickhouse.database import db
 from src.parser.chat import ChatParser
 from src.parser.clip import ClipParser
+from src.parser.session import close_session
 from src.parser.thirdparties import ThirdPartyEmotesParser
 from src.parser.twitch_parser import TwitchParser
 
@@ -23,10 +24,10 @@ async def main():
     initialize(version_base=None, config_path="../configs")
     cfg = compose(config_name="parser")
 
-    video_ids = cfg.video_ids
     n_batches = cfg.n_batches
     top_k_categories = cfg.top_k_categories
     top_k_videos = cfg.top_k_videos
+    category_concurrency = cfg.category_concurrency
 
     client_id = os.getenv("CLIENT_ID")
     secret_key = os.getenv("SECRET_KEY")
@@ -37,37 +38,70 @@ async def main():
         database=cfg.ch_database,
         user=cfg.ch_user,
         password=cfg.ch_password,
+        compression=cfg.ch_compression,
+        settings={"insert_block_size": cfg.ch_insert_block_size},
     ) as pool:
 
-        await db.create_table("videos")
-        await db.create_table("clips")
-        await db.create_table("emotes")
-        await db.create_table("messages")
-
-        twitchParser = TwitchParser(client_id, secret_key)
-        clipParser = ClipParser(client_id, secret_key)
-        chatParser = ChatParser(client_id, secret_key)
-        emotesParser = ThirdPartyEmotesParser()
-
-        categories = await twitchParser.fetch_top_categories(top_k_categories)
-        for category_id, category_name in categories:
-            logging.info(f"Processing {category_name} category...")
-            # fetch videos data
-            videos = await twitchParser.fetch_videos_by_category(
-                category_id, top_k=top_k_videos
+        try:
+            await db.create_table("videos")
+            await db.create_table("clips")
+            await db.create_table("emotes")
+            await db.create_table("messages")
+            await db.create_table("messages_buffer")
+
+            twitchParser, clipParser, chatParser = await asyncio.gather(
+                TwitchParser.create(client_id, secret_key),
+                ClipParser.create(client_id, secret_key),
+                ChatParser.create(client_id, secret_key),
+            )
+            emotesParser = ThirdPartyEmotesParser()
+
+            async def process_clips(video_ids):
+                async for clips in clipParser.stream_clips(video_ids, n_batches):
+                    await db.buffered_insert(table_name="clips", values=clips)
+
+            async def process_emotes_and_comments(video_ids):
+                # comments are split into text and emotes by the stored emotes
+                emotes = await emotesParser.get_emotes(video_ids, pool)
+                await db.insert_in_table(table_name="emotes", values=emotes)
+                async for comments in chatParser.stream_comments(
+                    video_ids, n_batches, pool
+                ):
+                    await db.insert_columns(
+                        table_name="messages", columns=comments.columns()
+                    )
+
+            async def process_category(category_id, category_name):
+                async with semaphore:
+                    logging.info(f"Processing {category_name} category...")
+                    # fetch videos data
+                    videos = await twitchParser.fetch_videos_by_category(
+                        category_id, top_k=top_k_videos
+                    )
+                    video_ids = [video[0] for video in videos]
+                    # videos are read back by the parsers, so insert them at once
+                    await db.insert_in_table(table_name="videos", values=videos)
+                    # fetch clips, emotes and comments data
+                    await asyncio.gather(
+                        process_clips(video_ids),
+                        process_emotes_and_comments(video_ids),
+                    )
+                    logging.info(f"{category_name} category successfully processed.")
+
+            semaphore = asyncio.Semaphore(category_concurrency)
+            categories = await twitchParser.fetch_top_categories(top_k_categories)
+            await asyncio.gather(
+                *[
+                    process_category(category_id, category_name)
+                    for category_id, category_name in categories
+                ]
             )
-            video_ids = [video[0] for video in videos]
-            await db.insert_in_table(table_name="videos", values=videos)
-            # fetch clips data
-            clips = await clipParser.get_clips(video_ids, n_batches, pool)
-            await db.insert_in_table(table_name="clips", values=clips)
-            # fetch emotes data
-            emotes = await emotesParser.get_emotes(video_ids, pool)
-            await db.insert_in_table(table_name="emotes", values=emotes)
-            # fetch comments data
-            comments = await chatParser.get_comments(video_ids, n_batches, pool)
-            await db.insert_in_table(table_name="messages", values=comments)
-            logging.info(f"{category_name} category successfully processed.")
+            await db.flush_all()
+        except Exception:
+            logging.exception("Data collection failed")
+            raise
+        finally:
+            await close_session()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,76 @@
 import asyncio
 import os
-from typing import Any, Dict, List, Tuple, Union
+import re
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import aiohttp
-import more_itertools
+import orjson
 from asynch.cursors import DictCursor
 from asynch.pool import Pool
-from dateutil import parser
 from tqdm.asyncio import tqdm_asyncio
 
+from src.backend.clickhouse.database import db
+from src.parser.session import create_connector
 from src.parser.twitch_parser import TwitchParser
 
+_WORD_RE = re.compile(r"\S+")
+
+
+@dataclass
+class CommentBatch:
+    """
+    Comment data stored column by column, in the column order of the messages table.
+    """
+
+    ids: List[str] = field(default_factory=list)
+    video_ids: List[int] = field(default_factory=list)
+    created_at: List[datetime] = field(default_factory=list)
+    commenter_names: List[Optional[str]] = field(default_factory=list)
+    contents: List[Optional[str]] = field(default_factory=list)
+    texts: List[Optional[str]] = field(default_factory=list)
+    emotes: List[List[str]] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def columns(self) -> Tuple[List[Any], ...]:
+        """
+        Returns:
+            A tuple of the columns of the batch.
+        """
+        return (
+            self.ids,
+            self.video_ids,
+            self.created_at,
+            self.commenter_names,
+            self.contents,
+            self.texts,
+            self.emotes,
+        )
+
+    def merge(self, other: "CommentBatch"):
+        """
+        Appends the columns of another batch to the columns of the batch.
+
+        Args:
+            other: The batch to append.
+        """
+        for column, values in zip(self.columns(), other.columns()):
+            column.extend(values)
+
 
 class ChatParser(TwitchParser):
     def __init__(self, client_id: str, secret_key: str):
@@ -22,42 +82,44 @@ class ChatParser(TwitchParser):
             secret_key: The secret key for Twitch API.
         """
         super().__init__(client_id, secret_key)
-        self.channel_emotes = None
 
     def get_comment_data(
-        self, video_id: str | int, comment: Dict[str, Any]
-    ) -> Tuple[Any, ...]:
+        self,
+        video_id: str | int,
+        comment: Dict[str, Any],
+        emotes_set: FrozenSet[str],
+        comments: CommentBatch,
+    ):
         """
-        Extracts relevant data from a comment and formats it into a tuple.
+        Extracts relevant data from a comment and appends it to the columns
+        of a batch.
 
         Args:
             video_id: The ID of the video associated with the comment.
             comment: A dictionary containing the comment data.
-
-        Returns:
-            A tuple of the extracted comment data.
+            emotes_set: The names of the emotes available on the channel.
+            comments: The CommentBatch to append the comment data to.
         """
-        comment_id = comment["id"]
-        video_id = int(video_id)
-        created_at = parser.isoparse(comment["createdAt"]).replace(tzinfo=None)
-        commenter_name = (
+        comments.ids.append(comment["id"])
+        comments.video_ids.append(int(video_id))
+        comments.created_at.append(
+            datetime.fromisoformat(comment["createdAt"]).replace(tzinfo=None)
+        )
+        comments.commenter_names.append(
             comment["commenter"]["displayName"] if comment["commenter"] else None
         )
 
+        content = "".join(
+            fragment["text"] for fragment in comment["message"]["fragments"]
+        )
         text = []
         emotes = []
-        message_fragments = []
-        for fragment in comment["message"]["fragments"]:
-            message_fragments.append(fragment["text"])
-            for word in fragment["text"].split():
-                if word in self.channel_emotes:
-                    emotes.append(word)
-                else:
-                    text.append(word)
-        content = "".join(message_fragments)
-        text = " ".join(text)
-
-        return (comment_id, video_id, created_at, commenter_name, content, text, emotes)
+        for match in _WORD_RE.finditer(content):
+            word = match.group()
+            (emotes if word in emotes_set else text).append(word)
+        comments.contents.append(content)
+        comments.texts.append(" ".join(text))
+        comments.emotes.append(emotes)
 
     async def get_page_comments(
         self,
@@ -101,17 +163,49 @@ class ChatParser(TwitchParser):
         elif cursor and not video_start:
             payload["variables"]["cursor"] = cursor
 
-        async with session.post(url, headers=headers, json=payload) as response:
-            response = await response.json()
+        async with self._request_semaphore:
+            async with session.post(url, headers=headers, json=payload) as response:
+                response = orjson.loads(await response.read())
         return response
 
+    def _filter_page(
+        self,
+        video_id: int,
+        edges: List[Dict[str, Any]],
+        video_start: int,
+        video_end: int,
+        emotes_set: FrozenSet[str],
+        comments: CommentBatch,
+    ) -> bool:
+        """
+        Appends the comments of a page that lie within a given time range
+        to the columns of a batch.
+
+        Args:
+            video_id: The ID of the video.
+            edges: The comment edges of the page.
+            video_start: The start time of the time range in seconds.
+            video_end: The end time of the time range in seconds.
+            emotes_set: The names of the emotes available on the channel.
+            comments: The CommentBatch to append the comment data to.
+
+        Returns:
+            Whether the page reaches the end of the time range.
+        """
+        for edge in edges:
+            node = edge["node"]
+            if video_start <= node["contentOffsetSeconds"] < video_end:
+                self.get_comment_data(video_id, node, emotes_set, comments)
+        return bool(edges) and edges[-1]["node"]["contentOffsetSeconds"] >= video_end
+
     async def get_batch_comments(
         self,
         video_id: int,
         video_start: int,
         video_end: int,
         session: aiohttp.ClientSession,
-    ) -> List[Tuple[Any, ...]]:
+        emotes_set: FrozenSet[str],
+    ) -> CommentBatch:
         """
         Fetches comments for a specific video within a given time range.
 
@@ -120,43 +214,28 @@ class ChatParser(TwitchParser):
             video_start: The start time of the time range in seconds.
             video_end: The end time of the time range in seconds.
             session: An aiohttp.ClientSession instance.
+            emotes_set: The names of the emotes available on the channel.
 
         Returns:
-            A list of tuples containing the comment data.
+            A CommentBatch containing the comment data.
         """
-        comments = []
+        comments = CommentBatch()
         cursor = None
-        response = await self.get_page_comments(video_id, video_start, session=session)
-        comments_data = response["data"]["video"]["comments"]["edges"]
-        for comment in comments_data:
-            if (
-                comment["node"]["contentOffsetSeconds"] > video_start
-                and comment["node"]["contentOffsetSeconds"] < video_end
-            ):
-                comment = self.get_comment_data(video_id, comment["node"])
-                comments.append(comment)
-        if response["data"]["video"]["comments"]["pageInfo"]["hasNextPage"]:
-            cursor = response["data"]["video"]["comments"]["edges"][-1]["cursor"]
-
-        while cursor:
+        while True:
             response = await self.get_page_comments(
-                video_id, video_start=None, cursor=cursor, session=session
+                video_id,
+                video_start=None if cursor else video_start,
+                cursor=cursor,
+                session=session,
             )
-
-            comments_data = response["data"]["video"]["comments"]["edges"]
-            for comment in comments_data:
-                if (
-                    comment["node"]["contentOffsetSeconds"] > video_start
-                    and comment["node"]["contentOffsetSeconds"] < video_end
-                ):
-                    comment = self.get_comment_data(video_id, comment["node"])
-                    comments.append(comment)
-            if comments_data[-1]["node"]["contentOffsetSeconds"] >= video_end:
+            page = response["data"]["video"]["comments"]
+            edges = page["edges"]
+            done = self._filter_page(
+                video_id, edges, video_start, video_end, emotes_set, comments
+            )
+            if done or not page["pageInfo"]["hasNextPage"]:
                 break
-            if response["data"]["video"]["comments"]["pageInfo"]["hasNextPage"]:
-                cursor = response["data"]["video"]["comments"]["edges"][-1]["cursor"]
-            else:
-                cursor = None
+            cursor = edges[-1]["cursor"]
 
         return comments
 
@@ -165,8 +244,8 @@ class ChatParser(TwitchParser):
         video: Tuple[Any, ...],
         n_batches: int,
         session: aiohttp.ClientSession,
-        pool: Pool,
-    ) -> List[List[Tuple[Any, ...]]]:
+        emotes_set: FrozenSet[str],
+    ) -> List[CommentBatch]:
         """
         Fetches comments for a specific video, divided into batches.
 
@@ -174,26 +253,14 @@ class ChatParser(TwitchParser):
             video: A tuple containing video data.
             n_batches: The number of batches to divide the video into.
             session: An aiohttp.ClientSession instance.
-            pool: A Pool instance.
+            emotes_set: The names of the emotes available on the channel.
 
         Returns:
-            A list of lists containing tuples of comment data.
+            A list of CommentBatch instances, one for each batch.
         """
         video_id = video["id"]
-        broadcaster_id = video["user_id"]
-        duration_dt = self._parse_duration("PT" + video["duration"].upper())
-        batch_size = duration_dt.seconds / n_batches
-        batch_starts = [int(i * batch_size) for i in range(n_batches)]
-        batch_ends = [batch_start + batch_size for batch_start in batch_starts]
-
-        async with pool.acquire() as conn:
-            async with conn.cursor(cursor=DictCursor) as cursor:
-                await cursor.execute(
-                    "SELECT name FROM highlights.emotes WHERE broadcaster_id = %(broadcaster_id)s",
-                    {"broadcaster_id": int(broadcaster_id)},
-                )
-                records = await cursor.fetchall()
-        self.channel_emotes = [record["name"] for record in records]
+        duration = self._duration_seconds(video["duration"])
+        batch_starts, batch_ends = self._batch_bounds(duration, n_batches)
 
         tasks = []
         for i in range(n_batches):
@@ -203,41 +270,85 @@ class ChatParser(TwitchParser):
                     batch_starts[i],
                     batch_ends[i],
                     session,
+                    emotes_set,
                 )
             )
         comments = await asyncio.gather(*tasks)
         return comments
 
-    async def get_comments(
+    async def _load_emotes_for_broadcasters(
+        self, broadcaster_ids: Iterable[int], cursor: DictCursor
+    ) -> Dict[int, FrozenSet[str]]:
+        """
+        Fetches the emote names of several broadcasters with a single query.
+
+        Args:
+            broadcaster_ids: The IDs of the broadcasters.
+            cursor: An open DictCursor to run the query on.
+
+        Returns:
+            A dictionary mapping broadcaster IDs to sets of emote names.
+        """
+        broadcaster_ids = tuple(
+            int(broadcaster_id) for broadcaster_id in broadcaster_ids
+        )
+        if not broadcaster_ids:
+            return {}
+
+        await cursor.execute(
+            "SELECT broadcaster_id, name FROM highlights.emotes WHERE broadcaster_id IN %(ids)s",
+            {"ids": broadcaster_ids},
+        )
+        records = await cursor.fetchall()
+
+        emotes = defaultdict(set)
+        for record in records:
+            emotes[record["broadcaster_id"]].add(record["name"])
+        return {
+            broadcaster_id: frozenset(emotes[broadcaster_id])
+            for broadcaster_id in broadcaster_ids
+        }
+
+    async def stream_comments(
         self,
         video_ids: Union[str, List[str]],
         n_batches: int = 1,
         pool: Pool = None,
-    ) -> List[Tuple[Any, ...]]:
+        batch_size: int = 100000,
+    ) -> AsyncIterator[CommentBatch]:
         """
-        Fetches all comments for the specified videos.
+        Fetches all comments for the specified videos and yields them in batches
+        as soon as the videos are processed.
 
         Args:
             video_ids: A single video ID, or a list of video IDs.
             n_batches: The number of batches to divide each video into (optional).
             pool: A Pool instance (optional).
+            batch_size: The minimum number of comments in a yielded batch (optional).
 
-        Returns:
-            A list of tuples containing comment data.
+        Yields:
+            CommentBatch instances containing comment data.
         """
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for video_id in video_ids:
-                async with pool.acquire() as conn:
-                    async with conn.cursor(cursor=DictCursor) as cursor:
-                        await cursor.execute(
-                            "SELECT * FROM highlights.videos WHERE id = %(video_id)s",
-                            {"video_id": int(video_id)},
-                        )
-                        video = await cursor.fetchone()
-                tasks.append(self.get_video_comments(video, n_batches, session, pool))
-            comments = await tqdm_asyncio.gather(*tasks)
-
-        comments = list(more_itertools.collapse(comments, base_type=tuple))
+        async with pool.acquire() as conn:
+            async with conn.cursor(cursor=DictCursor) as cursor:
+                videos = await db.fetch_videos(video_ids, cursor)
+                emotes = await self._load_emotes_for_broadcasters(
+                    {video["user_id"] for video in videos.values()}, cursor
+                )
+        comments = CommentBatch()
+        async with aiohttp.ClientSession(connector=create_connector()) as session:
+            tasks = [
+                self.get_video_comments(
+                    video, n_batches, session, emotes[video["user_id"]]
+                )
+                for video in videos.values()
+            ]
+            for task in tqdm_asyncio.as_completed(tasks):
+                for batch in await task:
+                    comments.merge(batch)
+                if len(comments) >= batch_size:
+                    yield comments
+                    comments = CommentBatch()
 
-        return comments
+        if comments:
+            yield comments
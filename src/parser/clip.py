@@ -1,12 +1,12 @@
 import asyncio
-from datetime import datetime
-from typing import Any, List, Tuple, Union
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Any, AsyncIterator, List, Tuple, Union
 
 import aiohttp
-import more_itertools
-from asynch.cursors import DictCursor
-from asynch.pool import Pool
 
+from src.backend.clickhouse.database import db
+from src.parser.session import create_connector
 from src.parser.twitch_parser import TwitchParser
 
 
@@ -62,7 +62,7 @@ class ClipParser(TwitchParser):
                 (
                     clip["id"],
                     int(clip["video_id"]),
-                    datetime.strptime(clip["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
+                    datetime.fromisoformat(clip["created_at"]).replace(tzinfo=None),
                     int(clip["duration"]),
                     int(clip["view_count"]),
                     int(clip["vod_offset"]),
@@ -91,10 +91,10 @@ class ClipParser(TwitchParser):
         """
         broadcaster_id = video["user_id"]
         started_at = video["created_at"]
-        duration_dt = self._parse_duration("PT" + video["duration"].upper())
-        batch_size = duration_dt / n_batches
-        batch_starts = [started_at + i * batch_size for i in range(n_batches)]
-        batch_ends = [batch_start + batch_size for batch_start in batch_starts]
+        duration = self._duration_seconds(video["duration"])
+        batch_starts, batch_ends = self._batch_bounds(duration, n_batches)
+        batch_starts = [started_at + timedelta(seconds=start) for start in batch_starts]
+        batch_ends = [started_at + timedelta(seconds=end) for end in batch_ends]
 
         tasks = []
         for i in range(n_batches):
@@ -109,36 +109,37 @@ class ClipParser(TwitchParser):
         clips = await asyncio.gather(*tasks)
         return clips
 
-    async def get_clips(
+    async def stream_clips(
         self,
         video_ids: Union[str, List[str]],
         n_batches: int = 1,
-        pool: Pool = None,
-    ) -> List[Tuple[Any, ...]]:
+        batch_size: int = 65536,
+    ) -> AsyncIterator[List[Tuple[Any, ...]]]:
         """
-        Fetches all clips for the specified VODs.
+        Fetches all clips for the specified VODs and yields them in batches
+        as soon as the VODs are processed.
 
         Args:
             video_ids: A single VOD ID, or a list of VOD IDs.
             n_batches: The number of batches to divide each video into (optional).
-            pool: A Pool instance (optional).
+            batch_size: The minimum number of clips in a yielded batch (optional).
 
-        Returns:
-            A list of tuples containing clip data.
+        Yields:
+            Lists of tuples containing clip data.
         """
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for video_id in video_ids:
-                async with pool.acquire() as conn:
-                    async with conn.cursor(cursor=DictCursor) as cursor:
-                        await cursor.execute(
-                            "SELECT * FROM highlights.videos WHERE id = %(video_id)s",
-                            {"video_id": int(video_id)},
-                        )
-                        video = await cursor.fetchone()
-                tasks.append(self.get_video_clips(video, n_batches, session))
-            clips = await asyncio.gather(*tasks)
-
-        clips = list(more_itertools.collapse(clips, base_type=tuple))
-
-        return clips
+        videos = await db.fetch_videos(video_ids)
+        clips = []
+        async with aiohttp.ClientSession(connector=create_connector()) as session:
+            tasks = [
+                self.get_video_clips(video, n_batches, session)
+                for video in videos.values()
+            ]
+            for task in asyncio.as_completed(tasks):
+                # batches -> pages -> clips
+                clips.extend(chain.from_iterable(chain.from_iterable(await task)))
+                if len(clips) >= batch_size:
+                    yield clips
+                    clips = []
+
+        if clips:
+            yield clips
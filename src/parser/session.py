@@ -0,0 +1,48 @@
+from typing import Optional
+
+import aiohttp
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def create_connector() -> aiohttp.TCPConnector:
+    """
+    Creates a connector that bounds the number of open connections.
+
+    Returns:
+        An aiohttp.TCPConnector instance.
+    """
+    return aiohttp.TCPConnector(limit=64, limit_per_host=32, ttl_dns_cache=300)
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Gets the aiohttp.ClientSession shared by the API parsers, creating it
+    on first use.
+
+    Returns:
+        The shared aiohttp.ClientSession instance.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=300,
+                limit_per_host=50,
+                ttl_dns_cache=600,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True,
+            ),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+    return _session
+
+
+async def close_session():
+    """
+    Closes the shared aiohttp.ClientSession.
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
@@ -1,12 +1,39 @@
 import asyncio
-import itertools
 import logging
-from typing import List, Union
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import aiohttp
-from asynch.cursors import DictCursor
+import ijson
+import orjson
 from asynch.pool import Pool
 
+from src.parser.session import get_session
+
+# maximum number of broadcasters whose emotes are fetched at the same time.
+# BTTV and FFZ are both served by api.betterttv.net, so this keeps up to
+# 2 channel requests per broadcaster plus the 2 global sets on that host
+# within the shared session's limit of 50 connections per host
+MAX_CONCURRENT_BROADCASTERS = 20
+
+# number of video IDs above which they are sent as an external table
+# instead of being inlined into the query. collect.main passes at most
+# top_k_videos IDs per category and stays below it; the external table
+# is for callers passing whole ID lists, e.g. a backfill of all stored videos
+MAX_INLINE_VIDEO_IDS = 10000
+
+# emote sources stored with every emote row
+_BTTV_SOURCE = "bttv"
+_FFZ_SOURCE = "ffz"
+_STV_SOURCE = "7tv"
+
+# number of seconds the global emote sets are cached for
+GLOBAL_EMOTES_TTL = 3600
+
+# number of seconds a channel without emotes on a service is not re-requested
+NO_CHANNEL_TTL = 600
+
 
 class ThirdPartyEmotesParser:
     """
@@ -14,7 +41,125 @@ class ThirdPartyEmotesParser:
     """
 
     def __init__(self) -> None:
-        pass
+        # service -> (fetch time, global emote set data), kept per instance so
+        # the locks are only used on the event loop the parser runs on
+        self._global_cache: Dict[str, Tuple[float, Any]] = {}
+        self._global_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # (service, broadcaster ID) -> time until the channel is not re-requested
+        self._no_channel: Dict[Tuple[str, str], float] = {}
+        # shared by all get_emotes calls, which run for several categories at once
+        self._broadcaster_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BROADCASTERS)
+
+    async def _fetch_json(
+        self, url: str, session: aiohttp.ClientSession
+    ) -> Optional[Any]:
+        """
+        Gets the JSON data of a given URL.
+
+        Args:
+            url: The URL to request.
+            session: The aiohttp ClientSession to use for making the request.
+
+        Returns:
+            The decoded response data, or None if the response status is not 200.
+        """
+        async with session.get(url) as response:
+            if response.status == 200:
+                return orjson.loads(await response.read())
+        return None
+
+    async def _get_global(
+        self, service: str, url: str, session: aiohttp.ClientSession
+    ) -> Optional[Any]:
+        """
+        Gets the global emote set of a service, reusing it for GLOBAL_EMOTES_TTL
+        seconds since it is the same for every broadcaster.
+
+        Args:
+            service: The name of the service.
+            url: The URL of the global emote set.
+            session: The aiohttp ClientSession to use for making the request.
+
+        Returns:
+            The decoded global emote set, or None if it could not be fetched.
+        """
+        async with self._global_locks[service]:
+            entry = self._global_cache.get(service)
+            if entry and time.monotonic() - entry[0] < GLOBAL_EMOTES_TTL:
+                return entry[1]
+
+            data = await self._fetch_json(url, session)
+            if data is not None:
+                self._global_cache[service] = (time.monotonic(), data)
+            return data
+
+    def _is_missing_channel(self, service: str, broadcaster_id: str) -> bool:
+        """
+        Checks whether a channel recently had no emotes on a service.
+
+        Args:
+            service: The name of the service.
+            broadcaster_id: The ID of the broadcaster.
+
+        Returns:
+            True if the channel request should be skipped, False otherwise.
+        """
+        key = (service, str(broadcaster_id))
+        expires = self._no_channel.get(key)
+        if expires is None:
+            return False
+        if time.monotonic() < expires:
+            return True
+        del self._no_channel[key]
+        return False
+
+    def _record_channel_status(self, service: str, broadcaster_id: str, status: int):
+        """
+        Records a failed channel emote request. A 404 means the channel has no
+        emotes on the service and is cached for NO_CHANNEL_TTL seconds, while
+        other statuses may be transient and are only logged.
+
+        Args:
+            service: The name of the service.
+            broadcaster_id: The ID of the broadcaster.
+            status: The HTTP status of the response.
+        """
+        if status == 404:
+            self._no_channel[(service, str(broadcaster_id))] = (
+                time.monotonic() + NO_CHANNEL_TTL
+            )
+        else:
+            logging.warning(
+                f"Failed to get {service} emotes of broadcaster {broadcaster_id}: HTTP {status}"
+            )
+
+    async def _get_channel(
+        self,
+        service: str,
+        broadcaster_id: str,
+        url: str,
+        session: aiohttp.ClientSession,
+    ) -> Optional[Any]:
+        """
+        Gets the channel emote set of a broadcaster on a service, skipping
+        channels that recently returned a 404 response.
+
+        Args:
+            service: The name of the service.
+            broadcaster_id: The ID of the broadcaster.
+            url: The URL of the channel emote set.
+            session: The aiohttp ClientSession to use for making the request.
+
+        Returns:
+            The decoded channel emote set, or None if it could not be fetched.
+        """
+        if self._is_missing_channel(service, broadcaster_id):
+            return None
+        async with session.get(url) as response:
+            if response.status == 200:
+                return orjson.loads(await response.read())
+            self._record_channel_status(service, broadcaster_id, response.status)
+        return None
 
     async def get_bttv_emotes(
         self, broadcaster_id: str, session: aiohttp.ClientSession
@@ -31,32 +176,39 @@ class ThirdPartyEmotesParser:
             A list of tuples containing the emote ID, broadcaster ID, emote
             source, and emote code.
         """
-        async with session.get(
-            "https://api.betterttv.net/3/cached/emotes/global"
-        ) as response:
-            data = await response.json()
-        global_emotes = [
-            (str(global_emote["id"]), broadcaster_id, "bttv", global_emote["code"])
-            for global_emote in data
-        ]
-
-        channel_emotes = []
-        async with session.get(
-            f"https://api.betterttv.net/3/cached/users/twitch/{broadcaster_id}"
-        ) as response:
-            if response.status == 200:
-                data = await response.json()
-                channel_emotes = [
-                    (
-                        str(channel_emote["id"]),
-                        broadcaster_id,
-                        "bttv",
-                        channel_emote["code"],
-                    )
-                    for channel_emote in data["channelEmotes"]
-                ]
+        global_data, channel_data = await asyncio.gather(
+            self._get_global(
+                "bttv", "https://api.betterttv.net/3/cached/emotes/global", session
+            ),
+            self._get_channel(
+                "bttv",
+                broadcaster_id,
+                f"https://api.betterttv.net/3/cached/users/twitch/{broadcaster_id}",
+                session,
+            ),
+        )
+        emotes = []
+        emotes.extend(
+            (
+                str(global_emote["id"]),
+                broadcaster_id,
+                _BTTV_SOURCE,
+                global_emote["code"],
+            )
+            for global_emote in global_data or []
+        )
+        if channel_data is not None:
+            emotes.extend(
+                (
+                    str(channel_emote["id"]),
+                    broadcaster_id,
+                    _BTTV_SOURCE,
+                    channel_emote["code"],
+                )
+                for channel_emote in channel_data["channelEmotes"]
+            )
 
-        return global_emotes + channel_emotes
+        return emotes
 
     async def get_ffz_emotes(
         self, broadcaster_id: str, session: aiohttp.ClientSession
@@ -73,32 +225,36 @@ class ThirdPartyEmotesParser:
             A list of tuples containing the emote ID, broadcaster ID, emote
             source, and emote code.
         """
-        async with session.get(
-            "https://api.betterttv.net/3/cached/frankerfacez/emotes/global"
-        ) as response:
-            data = await response.json()
-        global_emotes = [
-            (str(global_emote["id"]), broadcaster_id, "ffz", global_emote["code"])
-            for global_emote in data
-        ]
-
-        channel_emotes = []
-        async with session.get(
-            f"https://api.betterttv.net/3/cached/frankerfacez/users/twitch/{broadcaster_id}"
-        ) as response:
-            if response.status == 200:
-                data = await response.json()
-                channel_emotes = [
-                    (
-                        str(channel_emote["id"]),
-                        broadcaster_id,
-                        "ffz",
-                        channel_emote["code"],
-                    )
-                    for channel_emote in data
-                ]
+        global_data, channel_data = await asyncio.gather(
+            self._get_global(
+                "ffz",
+                "https://api.betterttv.net/3/cached/frankerfacez/emotes/global",
+                session,
+            ),
+            self._get_channel(
+                "ffz",
+                broadcaster_id,
+                f"https://api.betterttv.net/3/cached/frankerfacez/users/twitch/{broadcaster_id}",
+                session,
+            ),
+        )
+        emotes = []
+        emotes.extend(
+            (str(global_emote["id"]), broadcaster_id, _FFZ_SOURCE, global_emote["code"])
+            for global_emote in global_data or []
+        )
+        if channel_data is not None:
+            emotes.extend(
+                (
+                    str(channel_emote["id"]),
+                    broadcaster_id,
+                    _FFZ_SOURCE,
+                    channel_emote["code"],
+                )
+                for channel_emote in channel_data
+            )
 
-        return global_emotes + channel_emotes
+        return emotes
 
     async def get_7tv_emotes(
         self, broadcaster_id: str, session: aiohttp.ClientSession
@@ -115,31 +271,54 @@ class ThirdPartyEmotesParser:
             A list of tuples containing the emote ID, broadcaster ID, emote
             source, and emote code.
         """
-        async with session.get("https://7tv.io/v3/emote-sets/global") as response:
-            data = await response.json()
-        global_emotes = [
-            (str(global_emote["id"]), broadcaster_id, "7tv", global_emote["name"])
-            for global_emote in data["emotes"]
-        ]
-
-        channel_emotes = []
-        async with session.get(
-            f"https://7tv.io/v3/users/twitch/{broadcaster_id}"
-        ) as response:
-            if response.status == 200:
-                data = await response.json()
-                emote_set = data["emote_set"]
-                channel_emotes = [
-                    (
-                        str(channel_emote["id"]),
-                        broadcaster_id,
-                        "7tv",
-                        channel_emote["name"],
-                    )
-                    for channel_emote in emote_set["emotes"]
-                ]
+        global_data, channel_emotes = await asyncio.gather(
+            self._get_global("7tv", "https://7tv.io/v3/emote-sets/global", session),
+            self._stream_7tv_channel_emotes(broadcaster_id, session),
+        )
+        emotes = []
+        emotes.extend(
+            (str(global_emote["id"]), broadcaster_id, _STV_SOURCE, global_emote["name"])
+            for global_emote in (global_data or {}).get("emotes", [])
+        )
+        emotes.extend(channel_emotes)
 
-        return global_emotes + channel_emotes
+        return emotes
+
+    async def _stream_7tv_channel_emotes(
+        self, broadcaster_id: str, session: aiohttp.ClientSession
+    ) -> List[tuple]:
+        """
+        Gets the channel emotes for a given broadcaster ID from 7TV, parsing
+        the response while it is downloaded instead of decoding it at once.
+
+        Args:
+            broadcaster_id: The ID of the broadcaster.
+            session: The aiohttp ClientSession to use for making the request.
+
+        Returns:
+            A list of tuples containing the emote ID, broadcaster ID, emote
+            source, and emote code, empty if the response status is not 200.
+        """
+        emotes = []
+        if self._is_missing_channel("7tv", broadcaster_id):
+            return emotes
+        url = f"https://7tv.io/v3/users/twitch/{broadcaster_id}"
+        async with session.get(url) as response:
+            if response.status != 200:
+                self._record_channel_status("7tv", broadcaster_id, response.status)
+            else:
+                async for channel_emote in ijson.items_async(
+                    response.content, "emote_set.emotes.item"
+                ):
+                    emotes.append(
+                        (
+                            str(channel_emote["id"]),
+                            broadcaster_id,
+                            _STV_SOURCE,
+                            channel_emote["name"],
+                        )
+                    )
+        return emotes
 
     async def get_all_channel_emotes(
         self, broadcaster_id: str, session: aiohttp.ClientSession
@@ -151,16 +330,20 @@ class ThirdPartyEmotesParser:
         Args:
             broadcaster_id: The ID of the broadcaster.
             session: The aiohttp ClientSession to use for making the requests.
-            pool: The database pool to use for the request.
 
         Returns:
             A list of tuples containing the emote ID, broadcaster ID, emote
             source, and emote code.
         """
-        bttv_emotes = await self.get_bttv_emotes(broadcaster_id, session)
-        ffz_emotes = await self.get_ffz_emotes(broadcaster_id, session)
-        stv_emotes = await self.get_7tv_emotes(broadcaster_id, session)
-        all_emotes = list(set(bttv_emotes + ffz_emotes + stv_emotes))
+        bttv_emotes, ffz_emotes, stv_emotes = await asyncio.gather(
+            self.get_bttv_emotes(broadcaster_id, session),
+            self.get_ffz_emotes(broadcaster_id, session),
+            self.get_7tv_emotes(broadcaster_id, session),
+        )
+        all_emotes = set(bttv_emotes)
+        all_emotes.update(ffz_emotes)
+        all_emotes.update(stv_emotes)
+        all_emotes = list(all_emotes)
         logging.info(
             f"Successfully found {len(all_emotes)} emotes on channel of broadcaster {broadcaster_id}"
         )
@@ -170,6 +353,7 @@ class ThirdPartyEmotesParser:
         self,
         video_ids: Union[int, List[int], str, List[str]],
         pool: Pool,
+        session: aiohttp.ClientSession = None,
     ) -> List[tuple]:
         """
         Gets all the emotes for a given list of video IDs.
@@ -177,24 +361,40 @@ class ThirdPartyEmotesParser:
         Args:
             video_ids: A single video ID or a list of video IDs.
             pool: The database pool to use for the request.
+            session: The aiohttp ClientSession to use for making the requests (optional).
 
         Returns:
             A list of tuples containing the emote ID, broadcaster ID, emote
             source, and emote code.
         """
         video_ids = [int(video_id) for video_id in video_ids]
-        async with aiohttp.ClientSession() as session:
-            async with pool.acquire() as conn:
-                async with conn.cursor(cursor=DictCursor) as cursor:
+        if not video_ids:
+            return []
+        session = session or await get_session()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                if len(video_ids) > MAX_INLINE_VIDEO_IDS:
+                    # large IN lists are slow to send and parse, while an
+                    # external table is sent as a native data block
+                    cursor.set_external_table(
+                        "_video_ids",
+                        [("id", "UInt32")],
+                        [(video_id,) for video_id in video_ids],
+                    )
+                    await cursor.execute(
+                        "SELECT DISTINCT user_id FROM highlights.videos WHERE id IN _video_ids"
+                    )
+                else:
                     await cursor.execute(
                         "SELECT DISTINCT user_id FROM highlights.videos WHERE id IN %(video_ids)s",
                         {"video_ids": video_ids},
                     )
-                    records = await cursor.fetchall()
-            tasks = []
-            for record in records:
-                tasks.append(self.get_all_channel_emotes(record["user_id"], session))
-            emotes = await asyncio.gather(*tasks)
+                records = await cursor.fetchall()
 
-        emotes = list(itertools.chain.from_iterable(emotes))
-        return emotes
+        async def bounded(broadcaster_id):
+            async with self._broadcaster_semaphore:
+                return await self.get_all_channel_emotes(broadcaster_id, session)
+
+        emotes = await asyncio.gather(*(bounded(user_id) for (user_id,) in records))
+
+        return [emote for channel_emotes in emotes for emote in channel_emotes]
@@ -1,71 +1,157 @@
+import asyncio
 import re
-from datetime import datetime, timedelta
-from typing import Dict, List, Union
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
 
 import aiohttp
-import requests
+import numpy as np
+import orjson
+
+from src.parser.session import get_session
+
+# Twitch video duration, e.g. "1h23m45s"
+_DUR_RE = re.compile(r"(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?", re.I)
+
+# maximum number of IDs accepted by a single helix request
+MAX_IDS_PER_REQUEST = 100
+
+# maximum number of requests in flight per parser
+MAX_CONCURRENT_REQUESTS = 32
 
 
 class TwitchParser:
+    # client ID -> (access token, expiry time), shared by all parsers so that
+    # parsers of the same application reuse one token
+    _token_cache: Dict[str, Tuple[str, float]] = {}
+    # client ID -> (event loop, lock) guarding the token requests of the client
+    _token_locks: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Lock]] = {}
+
     def __init__(self, client_id: str, secret_key: str):
         self.client_id = client_id
         self.secret_key = secret_key
-        self.access_token = self._get_token()
+        # headers sent with every helix request, rebuilt when the token changes
+        self._headers: Dict[str, str] = {}
+        self._token: Optional[str] = None
+        self._request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    @classmethod
+    async def create(
+        cls,
+        client_id: str,
+        secret_key: str,
+        session: aiohttp.ClientSession = None,
+    ) -> "TwitchParser":
+        """
+        Creates a parser and requests its access token up front.
+
+        Args:
+            client_id: The client ID for Twitch API.
+            secret_key: The secret key for Twitch API.
+            session: An aiohttp.ClientSession instance (optional).
 
-    def _get_token(self) -> str:
+        Returns:
+            A parser instance holding a valid access token.
+        """
+        parser = cls(client_id, secret_key)
+        session = session or await get_session()
+        await parser._ensure_token(session)
+        return parser
+
+    def _get_token_lock(self) -> asyncio.Lock:
         """
-        Loads an OAuth client credentials flow App token for an associated client id
-        to an environment variables.
+        Gets the lock guarding the token requests of the client id, creating a
+        new one when the event loop changed since the lock was created.
+
+        Returns:
+            An asyncio.Lock instance bound to the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        entry = TwitchParser._token_locks.get(self.client_id)
+        if entry is None or entry[0] is not loop:
+            entry = (loop, asyncio.Lock())
+            TwitchParser._token_locks[self.client_id] = entry
+        return entry[1]
+
+    async def _ensure_token(self, session: aiohttp.ClientSession) -> str:
+        """
+        Gets an OAuth client credentials flow App token for an associated client id,
+        requesting a new one only if no parser of the client id holds a token
+        or it is about to expire.
+
+        Args:
+            session: An aiohttp.ClientSession instance.
 
         Returns:
             The access token.
         """
-        auth_url = "https://id.twitch.tv/oauth2/token"
-        # parameters for token request with credentials
-        auth_params = {
-            "client_id": self.client_id,
-            "client_secret": self.secret_key,
-            "grant_type": "client_credentials",
-            "scope": "chat:read",
-        }
-        # Request response, using the url base and params to structure the request
-        auth_response = requests.post(auth_url, params=auth_params)
-        token = auth_response.json().get("access_token")
+        async with self._get_token_lock():
+            entry = TwitchParser._token_cache.get(self.client_id)
+            if entry is None or time.monotonic() >= entry[1] - 60:
+                auth_url = "https://id.twitch.tv/oauth2/token"
+                # parameters for token request with credentials
+                auth_params = {
+                    "client_id": self.client_id,
+                    "client_secret": self.secret_key,
+                    "grant_type": "client_credentials",
+                    "scope": "chat:read",
+                }
+                async with session.post(auth_url, params=auth_params) as response:
+                    data = orjson.loads(await response.read())
+                entry = (data["access_token"], time.monotonic() + data["expires_in"])
+                TwitchParser._token_cache[self.client_id] = entry
 
-        return token
+            if entry[0] != self._token:
+                self._token = entry[0]
+                self._headers = {
+                    "client-id": self.client_id,
+                    "Accept-Encoding": "gzip",
+                    "Authorization": f"Bearer {self._token}",
+                }
 
-    def _parse_duration(self, iso_duration):
+            return self._token
+
+    def _invalidate_token(self):
+        """
+        Drops the token of the parser from the shared cache, unless another
+        parser already replaced it.
         """
-        Parses an ISO 8601 duration string into a datetime.timedelta instance.
+        entry = TwitchParser._token_cache.get(self.client_id)
+        if entry is not None and entry[0] == self._token:
+            del TwitchParser._token_cache[self.client_id]
+
+    def _duration_seconds(self, duration: str) -> int:
+        """
+        Parses a Twitch video duration string (e.g. "1h23m45s") into seconds.
 
         Args:
-            iso_duration: an ISO 8601 duration string.
+            duration: a Twitch video duration string.
 
         Returns:
-            A datetime.timedelta instance
+            The total number of seconds.
         """
-        m = re.match(
-            r"^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)D)?T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:.\d+)?)S)?$",
-            iso_duration,
-        )
+        m = _DUR_RE.fullmatch(duration)
         if m is None:
-            raise ValueError("invalid ISO 8601 duration string")
+            raise ValueError("invalid Twitch duration string")
+
+        hours, minutes, seconds = m.groups()
+        return int(hours or 0) * 3600 + int(minutes or 0) * 60 + int(seconds or 0)
 
-        days = 0
-        hours = 0
-        minutes = 0
-        seconds = 0.0
+    def _batch_bounds(
+        self, duration: int, n_batches: int
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Splits a duration into batches of whole seconds.
 
-        if m[3]:
-            days = int(m[3])
-        if m[4]:
-            hours = int(m[4])
-        if m[5]:
-            minutes = int(m[5])
-        if m[6]:
-            seconds = float(m[6])
+        Args:
+            duration: The duration to split in seconds.
+            n_batches: The number of batches.
 
-        return timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
+        Returns:
+            A tuple of the lists of batch start and end offsets in seconds.
+        """
+        edges = np.linspace(0, duration, n_batches + 1, dtype=np.int64).tolist()
+        return edges[:-1], edges[1:]
 
     async def request_get(self, query: str, fields: Dict, session) -> Dict:
         """
@@ -80,25 +166,35 @@ class TwitchParser:
             A dict containing the response data.
         """
         base_url = "https://api.twitch.tv/helix/"
-        headers = {
-            "client-id": self.client_id,
-            "Authorization": f"Bearer {self.access_token}",
-        }
-        async with session.get(
-            base_url + query, headers=headers, params=fields
-        ) as response:
-            response = await response.json()
+        # retry once with a new token if the cached one was revoked
+        for retry in (True, False):
+            await self._ensure_token(session)
+            async with self._request_semaphore:
+                async with session.get(
+                    base_url + query, headers=self._headers, params=fields
+                ) as response:
+                    if response.status == 401 and retry:
+                        self._invalidate_token()
+                        continue
+                    response = orjson.loads(await response.read())
 
-        return response
+            return response
 
     async def fetch_videos_by_ids(
-        self, video_ids: Union[int, List[int], str, List[str]]
+        self,
+        video_ids: Union[int, List[int], str, List[str]],
+        session: aiohttp.ClientSession = None,
+        parse_datetimes: bool = True,
     ) -> List[Dict]:
         """
         Fetches metadata of the specified VODs.
 
         Args:
             video_ids: A single VOD ID, a list of VOD IDs, a single VOD ID as a string, or a list of VOD IDs as strings.
+            session: An aiohttp.ClientSession instance (optional).
+            parse_datetimes: Whether to parse the creation times into datetime
+                instances instead of keeping them as ISO 8601 strings. Both are
+                naive UTC, so they are inserted as the same value (optional).
 
         Returns:
             A list of dictionaries containing the video metadata.
@@ -107,23 +203,38 @@ class TwitchParser:
             raise TypeError(f"{video_ids} provided for video_ids")
         video_ids = [str(video_id) for video_id in video_ids]
 
-        async with aiohttp.ClientSession() as session:
-            response = await self.request_get("videos", {"id": video_ids}, session)
-            videos = [
+        session = session or await get_session()
+        chunks = [
+            video_ids[i : i + MAX_IDS_PER_REQUEST]
+            for i in range(0, len(video_ids), MAX_IDS_PER_REQUEST)
+        ]
+        responses = await asyncio.gather(
+            *[self.request_get("videos", {"id": chunk}, session) for chunk in chunks]
+        )
+        videos = [
+            (
+                int(video["id"]),
+                int(video["user_id"]),
                 (
-                    int(video["id"]),
-                    int(video["user_id"]),
-                    datetime.strptime(video["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
-                    video["duration"],
-                    int(video["view_count"]),
-                )
-                for video in response["data"]
-            ]
+                    datetime.fromisoformat(video["created_at"]).replace(tzinfo=None)
+                    if parse_datetimes
+                    else video["created_at"].removesuffix("Z")
+                ),
+                video["duration"],
+                int(video["view_count"]),
+            )
+            for response in responses
+            for video in response["data"]
+        ]
 
         return videos
 
     async def fetch_videos_by_category(
-        self, category_id: Union[int, str], top_k: int = 10
+        self,
+        category_id: Union[int, str],
+        top_k: int = 10,
+        session: aiohttp.ClientSession = None,
+        parse_datetimes: bool = True,
     ) -> List[Dict]:
         """
         Fetches metadata of the videos of specified game or category.
@@ -131,6 +242,10 @@ class TwitchParser:
         Args:
             category_id: A single category_id as int or string
             top_k: The maximum number of videos to return.  1 <= top_k <= 100. The default is 10.
+            session: An aiohttp.ClientSession instance (optional).
+            parse_datetimes: Whether to parse the creation times into datetime
+                instances instead of keeping them as ISO 8601 strings. Both are
+                naive UTC, so they are inserted as the same value (optional).
 
         Returns:
             A list of tuples containing the videos metadata.
@@ -147,32 +262,42 @@ class TwitchParser:
             "first": top_k,
         }
 
-        async with aiohttp.ClientSession() as session:
-            response = await self.request_get("videos", params, session)
-            videos = [
+        session = session or await get_session()
+        response = await self.request_get("videos", params, session)
+        videos = [
+            (
+                int(video["id"]),
+                int(video["user_id"]),
                 (
-                    int(video["id"]),
-                    int(video["user_id"]),
-                    datetime.strptime(video["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
-                    video["duration"],
-                    int(video["view_count"]),
-                )
-                for video in response["data"]
-            ]
+                    datetime.fromisoformat(video["created_at"]).replace(tzinfo=None)
+                    if parse_datetimes
+                    else video["created_at"].removesuffix("Z")
+                ),
+                video["duration"],
+                int(video["view_count"]),
+            )
+            for video in response["data"]
+        ]
 
         return videos
 
-    async def fetch_top_categories(self, top_k: int = 10) -> List[Dict]:
+    async def fetch_top_categories(
+        self, top_k: int = 10, session: aiohttp.ClientSession = None
+    ) -> List[Dict]:
         """
         Fetches metadata of top categories or games.
 
+        Args:
+            top_k: The maximum number of categories to return. The default is 10.
+            session: An aiohttp.ClientSession instance (optional).
+
         Returns:
             A list of tuples containing the categories metadata.
         """
-        async with aiohttp.ClientSession() as session:
-            response = await self.request_get("games/top", None, session)
-            videos = [
-                (int(category["id"]), category["name"]) for category in response["data"]
-            ]
+        session = session or await get_session()
+        response = await self.request_get("games/top", None, session)
+        videos = [
+            (int(category["id"]), category["name"]) for category in response["data"]
+        ]
 
         return videos[0:top_k]